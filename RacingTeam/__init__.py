@@ -2,7 +2,10 @@
 import json
 import html
 import logging
+import os
 import traceback
+from functools import partial
+from typing import Optional
 from telegram import ParseMode, Update
 from telegram.ext import (
     CallbackContext,
@@ -11,17 +14,8 @@ from telegram.ext import (
     Updater,
 )
 
-from .private import DEVELOPER_CHAT_ID, BOT_TOKEN
-
 logger = logging.getLogger()
 
-updater = Updater(
-    token=BOT_TOKEN,
-    persistence=PicklePersistence(filename="telegram_data.pkl"),
-    use_context=True,
-    arbitrary_callback_data=True,
-)
-
 
 def start(update: Update, context: CallbackContext):
     welcome = """Hallo,
@@ -34,7 +28,9 @@ Für Verbindungen nutz einfach /route.
     update.message.reply_text(text=welcome)
 
 
-def error_handler(update: object, context: CallbackContext) -> None:
+def error_handler(
+    update: object, context: CallbackContext, developer_chat_id: Optional[int] = None
+) -> None:
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
     tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
     tb_string = "".join(tb_list)
@@ -52,7 +48,8 @@ def error_handler(update: object, context: CallbackContext) -> None:
     )
 
     # Finally, send the message
-    context.bot.send_message(chat_id=DEVELOPER_CHAT_ID, text=message, parse_mode=ParseMode.HTML)
+    if developer_chat_id is not None:
+        context.bot.send_message(chat_id=developer_chat_id, text=message, parse_mode=ParseMode.HTML)
     # Notify user
     update.effective_chat.send_message(
         "Entschuldigung irgendetwas ist schiefgelaufen, probier es noch einmal."
@@ -91,7 +88,13 @@ def help(update: Update, context: CallbackContext):
     )
 
 
-def init():
+def init(updater: Updater, developer_chat_id: Optional[int] = None):
+    """Register all handlers
+
+    Args:
+        updater: Updater to register the handlers on
+        developer_chat_id: Chat to report errors to
+    """
     dispatcher = updater.dispatcher
     from . import departures, route
 
@@ -101,13 +104,31 @@ def init():
     # Put departure handlers into group 1 to prevent issues with route handlers
     [dispatcher.add_handler(handler, 1) for handler in departures.handlers]
 
-    dispatcher.add_error_handler(error_handler)
+    dispatcher.add_error_handler(partial(error_handler, developer_chat_id=developer_chat_id))
 
 
 def main():
+    from .private import DEVELOPER_CHAT_ID, BOT_TOKEN
+
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
     )
 
-    init()
+    updater = Updater(
+        token=BOT_TOKEN,
+        persistence=PicklePersistence(filename="telegram_data.pkl"),
+        use_context=True,
+        arbitrary_callback_data=True,
+    )
+    init(updater, DEVELOPER_CHAT_ID)
+
+    # Record traffic for replaying it with RacingTeam-loadtest
+    recorder = None
+    if os.environ.get("RACINGTEAM_RECORD"):
+        from .loadtest import record
+
+        recorder = record(updater, os.environ["RACINGTEAM_RECORD"])
     updater.start_polling()
+    updater.idle()
+    if recorder:
+        recorder.close()
@@ -0,0 +1,721 @@
+"""Record production traffic and replay it as load test
+
+Recording wraps the update queue and the VVO client, incoming updates and the VVO responses
+they caused are written anonymized to gzip compressed pickle logs.
+Replaying feeds the log into the dispatcher built by `RacingTeam.init()`, Telegram is
+replaced by a local fake Bot API server and VVO answers from the recorded responses.
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import glob
+import gzip
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import logging
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterable, Iterator, Optional
+
+import vvo
+from telegram import Update
+from telegram.ext import ExtBot, PicklePersistence, Updater
+from telegram.utils.request import Request
+
+from . import init
+
+logger = logging.getLogger(__name__)
+
+# VVO functions used by the handlers, these are recorded and faked
+VVO_FUNCTIONS = ("find_stops", "get_departures", "find_routes")
+# Decimal places kept of locations, 3 places are roughly 100 m
+LOCATION_PRECISION = 3
+# Distances of stops are rounded to the same precision, as they reveal the location too
+DISTANCE_PRECISION = -2
+# zlib window bits for reading gzip data
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+FAKE_TOKEN = "123456:LOADTEST"
+# Dispatcher workers, the default of the production updater
+WORKERS = 4
+FAKE_BOT = {"id": 123456, "is_bot": True, "first_name": "RacingTeam", "username": "RacingTeamBot"}
+
+
+def vvo_key(name: str, args: tuple, kwargs: dict) -> str:
+    """Create lookup key for a VVO call
+
+    Points are identified by their ID and locations are rounded like the recorded updates,
+    so a replayed call finds the response recorded for the original call.
+    """
+
+    def normalize(value):
+        if isinstance(value, vvo.Point):
+            return ("point", value.id)
+        if isinstance(value, float):
+            return round(value, LOCATION_PRECISION)
+        if isinstance(value, (tuple, list)):
+            return tuple(normalize(v) for v in value)
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return value
+
+    return repr((name, normalize(args), sorted((k, normalize(v)) for k, v in kwargs.items())))
+
+
+def memory_usage() -> int:
+    """Resident set size of this process in bytes"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # Only the peak size is available here, in bytes on macOS and kilobytes elsewhere
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+####################################################################
+# Recording
+
+
+class Anonymizer:
+    """Remove personal data from update dicts
+
+    User and chat IDs are replaced by pseudonyms, which are stable for one recording session,
+    names, signatures, captions, venues and the texts and button labels of quoted or bot
+    messages are removed and locations are rounded.
+    Texts of incoming messages are kept as they are needed for replaying stop queries.
+    """
+
+    PERSON_KEYS = (
+        "from",
+        "chat",
+        "user",
+        "sender_chat",
+        "forward_from",
+        "forward_from_chat",
+        "new_chat_members",
+        "left_chat_member",
+    )
+    REMOVED_KEYS = (
+        "last_name",
+        "username",
+        "title",
+        "bio",
+        "language_code",
+        "contact",
+        "venue",
+        "caption",
+        "caption_entities",
+        "forward_sender_name",
+        "author_signature",
+        "forward_signature",
+    )
+    # Messages which are not the query itself, only their text is removed
+    NESTED_MESSAGE_KEYS = ("reply_to_message", "pinned_message")
+    TEXT_KEYS = ("text", "entities")
+    # Replaces button labels of nested messages, they contain e.g. distances to stops
+    BUTTON_TEXT = "Button"
+
+    def __init__(self, secret: Optional[bytes] = None):
+        self.secret = secret or os.urandom(16)
+
+    def pseudonym(self, value: int) -> int:
+        digest = hmac.new(self.secret, str(value).encode(), hashlib.sha256).digest()
+        pseudonym = int.from_bytes(digest[:6], "big")
+        return -pseudonym if value < 0 else pseudonym
+
+    def __call__(self, data, key: Optional[str] = None):
+        if isinstance(data, list):
+            return [self(value, key) for value in data]
+        if not isinstance(data, dict):
+            return data
+
+        result = {}
+        for k, value in data.items():
+            if k in self.REMOVED_KEYS:
+                continue
+            if key in self.PERSON_KEYS and k == "id":
+                value = self.pseudonym(value)
+            elif key in self.PERSON_KEYS and k == "first_name":
+                value = "User"
+            elif k in ("latitude", "longitude"):
+                value = round(value, LOCATION_PRECISION)
+            elif k in self.NESTED_MESSAGE_KEYS or (key == "callback_query" and k == "message"):
+                value = self.nested_message(self(value, k))
+            else:
+                value = self(value, k)
+            result[k] = value
+        return result
+
+    def nested_message(self, message: dict) -> dict:
+        message = {k: v for k, v in message.items() if k not in self.TEXT_KEYS}
+        if "reply_markup" in message:
+            markup = message["reply_markup"]
+            message["reply_markup"] = {
+                **markup,
+                "inline_keyboard": [
+                    [{**button, "text": self.BUTTON_TEXT} for button in row]
+                    for row in markup.get("inline_keyboard", [])
+                ],
+            }
+        return message
+
+
+def coarsen_distances(response):
+    """Copy of a VVO response with the distances of its points rounded
+
+    The exact distances of several stops reveal the location they were measured from.
+    """
+    points = getattr(response, "points", None)
+    if not points:
+        return response
+    response = copy.copy(response)
+    response.points = []
+    for point in points:
+        if getattr(point, "distance", None):
+            point = copy.copy(point)
+            point.distance = int(round(point.distance, DISTANCE_PRECISION))
+        response.points.append(point)
+    return response
+
+
+class Recorder:
+    """Write updates and VVO responses to a new traffic log
+
+    Every record is flushed, so the log stays readable while the bot is running.
+    Recording never raises, after the first failed write the recorder is disabled.
+
+    Args:
+        filename: Traffic log, must not exist
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._file = gzip.open(filename, "xb")
+        self._lock = threading.Lock()
+        self.enabled = True
+        self.anonymize = Anonymizer()
+
+    def close(self):
+        with self._lock:
+            self.enabled = False
+            try:
+                self._file.close()
+            except Exception:
+                logger.exception("Could not close traffic log %s", self.filename)
+
+    def write(self, *record):
+        try:
+            data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            logger.exception("Could not record %s", record[0])
+            return
+        with self._lock:
+            if not self.enabled:
+                return
+            try:
+                self._file.write(data)
+                self._file.flush()
+            except Exception:
+                self.enabled = False
+                logger.exception("Could not write traffic log %s, recording stopped", self.filename)
+
+    def record_update(self, update: Update):
+        try:
+            self.write("update", time.time(), self.anonymize(update.to_dict()))
+        except Exception:
+            logger.exception("Could not record update")
+
+    def wrap_vvo(self, name: str, function):
+        """Wrap VVO function to record its responses"""
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            response = function(*args, **kwargs)
+            duration = time.perf_counter() - start
+            try:
+                data = pickle.dumps(coarsen_distances(response), protocol=pickle.HIGHEST_PROTOCOL)
+                self.write("vvo", time.time(), name, vvo_key(name, args, kwargs), duration, data)
+            except Exception:
+                logger.exception("Could not record response of vvo.%s", name)
+            return response
+
+        return wrapper
+
+
+def record(updater: Updater, directory: str) -> Recorder:
+    """Record all updates received by updater and all VVO responses
+
+    Every session writes its own log into directory, updates are recorded when they are
+    queued, so the log contains their arrival times and not the times they were processed.
+    """
+    os.makedirs(directory, exist_ok=True)
+    recorder = Recorder(
+        os.path.join(directory, f"traffic-{datetime.now():%Y%m%d-%H%M%S-%f}.log.gz")
+    )
+    put = updater.update_queue.put
+
+    def recording_put(update, *args, **kwargs):
+        # Never fail here, an exception would stop the polling thread
+        if isinstance(update, Update):
+            recorder.record_update(update)
+        put(update, *args, **kwargs)
+
+    updater.update_queue.put = recording_put
+    for name in VVO_FUNCTIONS:
+        setattr(vvo, name, recorder.wrap_vvo(name, getattr(vvo, name)))
+    return recorder
+
+
+def decompress(file) -> Iterator[bytes]:
+    """Decompress all gzip members of file
+
+    Unlike `gzip` the data in front of a corrupted block is returned before `zlib.error` is
+    raised, so an unfinished log followed by other data can still be read.
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    pending = b""
+    careful = False
+    while True:
+        if not pending:
+            pending = file.read(io.DEFAULT_BUFFER_SIZE)
+            if not pending:
+                return
+        chunk, rest = (pending[:1], pending[1:]) if careful else (pending, b"")
+        backup = decompressor.copy()
+        try:
+            data = decompressor.decompress(chunk)
+        except zlib.error:
+            if careful:
+                raise
+            # Retry byte by byte to find the last data in front of the corrupted block
+            decompressor, careful = backup, True
+            continue
+        yield data
+        pending = rest
+        if decompressor.eof:
+            pending = decompressor.unused_data + pending
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+
+
+def read_log(filename: str) -> Iterator[tuple]:
+    """Read records of a traffic log
+
+    Logs truncated by a running bot or followed by corrupted data are read up to their last
+    complete record.
+    """
+    data = io.BytesIO()
+    with open(filename, "rb") as file:
+        try:
+            for chunk in decompress(file):
+                data.write(chunk)
+        except zlib.error:
+            logger.warning("Traffic log %s is corrupted, skipping its remainder", filename)
+    data.seek(0)
+    while True:
+        try:
+            yield pickle.load(data)
+        except EOFError:
+            return
+        except pickle.UnpicklingError:
+            logger.warning("Traffic log %s ends with an incomplete record", filename)
+            return
+
+
+def find_logs(paths: Iterable[str]) -> list[str]:
+    """Expand directories written by `record()` into their traffic logs"""
+    logs = []
+    for path in paths:
+        if os.path.isdir(path):
+            logs += sorted(glob.glob(os.path.join(path, "traffic-*.log.gz")))
+        else:
+            logs.append(path)
+    return logs
+
+
+####################################################################
+# Fakes
+
+
+class FakeVVO:
+    """Answer VVO requests with recorded responses
+
+    Requests are matched by their arguments, requests never recorded are answered with any
+    recorded response of the same function and counted as misses.
+
+    Args:
+        latency: Factor for the recorded VVO response times, 0 answers immediately
+    """
+
+    def __init__(self, latency: float = 1.0):
+        self.latency = latency
+        self.requests = 0
+        self.misses = 0
+        self._responses: dict[str, list[tuple[float, bytes]]] = {}
+        self._calls = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, key: str, duration: float, data: bytes):
+        self._responses.setdefault(key, []).append((duration, data))
+        self._responses.setdefault(name, []).append((duration, data))
+
+    def function(self, name: str):
+        def fake(*args, **kwargs):
+            key = vvo_key(name, args, kwargs)
+            with self._lock:
+                self.requests += 1
+                if key not in self._responses:
+                    self.misses += 1
+                    key = name
+                if key not in self._responses:
+                    raise RuntimeError(f"No response of vvo.{name} recorded")
+                responses = self._responses[key]
+                duration, data = responses[self._calls[key] % len(responses)]
+                self._calls[key] += 1
+            if self.latency:
+                time.sleep(duration * self.latency)
+            # Unpickle on every call, so every request allocates its own response like VVO
+            return pickle.loads(data)
+
+        return fake
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        data = json.loads(body) if self.headers.get_content_type() == "application/json" else {}
+        if self.server.delay:
+            time.sleep(self.server.delay)
+
+        payload = json.dumps({"ok": True, "result": self.server.answer(method, data)}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramAPI(ThreadingHTTPServer):
+    """Local Bot API server answering every request successfully
+
+    Args:
+        delay: Seconds to wait before answering a request
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay: float = 0.0):
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.delay = delay
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/bot"
+
+    def answer(self, method: str, data: dict):
+        with self._lock:
+            self.calls[method] += 1
+            message_id = next(self._message_ids)
+        if method == "getMe":
+            return FAKE_BOT
+        if method.startswith(("send", "edit")) and method != "sendChatAction":
+            return {
+                "message_id": data.get("message_id", message_id),
+                "date": int(time.time()),
+                "chat": {"id": data.get("chat_id", 0), "type": "private"},
+            }
+        return True
+
+
+####################################################################
+# Replay
+
+
+class Replay:
+    """Replay traffic logs against the dispatcher built by `RacingTeam.init()`
+
+    Args:
+        filenames: Traffic logs written by `record()`
+        speed: Speed-up factor for the recorded time between updates, 0 replays without pauses
+        api_delay: Seconds the fake Telegram API waits before answering
+        vvo_latency: Factor for the recorded VVO response times, 0 answers immediately
+        sample_interval: Seconds between memory samples
+        trace_memory: Sample memory allocated by Python using tracemalloc instead of the
+            resident set size, this slows down the replay and inflates all timings
+    """
+
+    def __init__(
+        self,
+        filenames: Iterable[str],
+        speed: float = 1.0,
+        api_delay: float = 0.0,
+        vvo_latency: float = 1.0,
+        sample_interval: float = 1.0,
+        trace_memory: bool = False,
+    ):
+        self.filenames = list(filenames)
+        self.speed = speed
+        self.api_delay = api_delay
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.vvo = FakeVVO(vvo_latency)
+        self.api: Optional[FakeTelegramAPI] = None
+
+        self.handler_latency: list[float] = []
+        self.queueing_delay: list[float] = []
+        self.persistence_time: list[float] = []
+        self.flush_time = 0.0
+        self.errors = 0
+        # (seconds since start, processed updates, memory in bytes)
+        self.memory: list[tuple[float, int, int]] = []
+        self.elapsed = 0.0
+
+        self._updates: list[tuple[float, dict]] = []
+        self._enqueued: dict[int, float] = {}
+        # Persistence time of the update processed by the dispatcher thread, persistence
+        # updates of other threads (e.g. conversation timeouts of the job queue) are ignored
+        self._local = threading.local()
+        self._done = threading.Event()
+        self._begin = 0.0
+
+    def load(self):
+        for filename in self.filenames:
+            for record in read_log(filename):
+                if record[0] == "update":
+                    self._updates.append(record[1:])
+                elif record[0] == "vvo":
+                    self.vvo.add(*record[2:])
+        if not self._updates:
+            raise ValueError(f"No updates recorded in {', '.join(self.filenames)}")
+        self._updates.sort(key=lambda update: update[0])
+
+    def _process_update(self, process_update, update):
+        start = time.perf_counter()
+        self.queueing_delay.append(start - self._enqueued.pop(id(update)))
+        self._local.persisted = 0.0
+        process_update(update)
+        persisted = self._local.persisted
+        self.persistence_time.append(persisted)
+        self.handler_latency.append(time.perf_counter() - start - persisted)
+        if len(self.handler_latency) == len(self._updates):
+            self._done.set()
+
+    def _update_persistence(self, update_persistence, update=None):
+        start = time.perf_counter()
+        update_persistence(update=update)
+        if hasattr(self._local, "persisted"):
+            self._local.persisted += time.perf_counter() - start
+
+    def _count_error(self, update: object, context):
+        self.errors += 1
+
+    def _sample_memory(self):
+        self.memory.append(
+            (
+                time.perf_counter() - self._begin,
+                len(self.handler_latency),
+                tracemalloc.get_traced_memory()[0] if self.trace_memory else memory_usage(),
+            )
+        )
+
+    def _sampler(self):
+        while not self._done.wait(self.sample_interval):
+            self._sample_memory()
+
+    def run(self) -> Replay:
+        self.load()
+        self.api = FakeTelegramAPI(self.api_delay)
+        threading.Thread(target=self.api.serve_forever, daemon=True).start()
+        originals = {name: getattr(vvo, name) for name in VVO_FUNCTIONS}
+        for name in VVO_FUNCTIONS:
+            setattr(vvo, name, self.vvo.function(name))
+
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                persistence = PicklePersistence(filename=os.path.join(directory, "replay.pkl"))
+                # Same connection pool as the production updater creates for its bot
+                bot = ExtBot(
+                    FAKE_TOKEN,
+                    base_url=self.api.base_url,
+                    request=Request(con_pool_size=WORKERS + 4),
+                    arbitrary_callback_data=True,
+                )
+                updater = Updater(
+                    bot=bot, persistence=persistence, use_context=True, workers=WORKERS
+                )
+                init(updater)
+                updater.dispatcher.add_error_handler(self._count_error)
+                self._replay(updater)
+        finally:
+            for name, function in originals.items():
+                setattr(vvo, name, function)
+            self.api.shutdown()
+            self.api.server_close()
+        return self
+
+    def _replay(self, updater: Updater):
+        dispatcher = updater.dispatcher
+        process_update = dispatcher.process_update
+        update_persistence = dispatcher.update_persistence
+        dispatcher.process_update = lambda update: self._process_update(process_update, update)
+        dispatcher.update_persistence = lambda update=None: self._update_persistence(
+            update_persistence, update
+        )
+        updates = [(t, Update.de_json(data, updater.bot)) for t, data in self._updates]
+
+        ready = threading.Event()
+        threading.Thread(target=dispatcher.start, kwargs={"ready": ready}, daemon=True).start()
+        ready.wait()
+        updater.job_queue.start()
+
+        if self.trace_memory:
+            tracemalloc.start()
+        self._begin = time.perf_counter()
+        self._sample_memory()
+        sampler = threading.Thread(target=self._sampler, daemon=True)
+        sampler.start()
+
+        first = updates[0][0]
+        for timestamp, update in updates:
+            if self.speed > 0:
+                delay = self._begin + (timestamp - first) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            self._enqueued[id(update)] = time.perf_counter()
+            dispatcher.update_queue.put(update)
+
+        self._done.wait()
+        self.elapsed = time.perf_counter() - self._begin
+        sampler.join()
+        self._sample_memory()
+        if self.trace_memory:
+            tracemalloc.stop()
+
+        updater.job_queue.stop()
+        dispatcher.stop()
+        start = time.perf_counter()
+        updater.persistence.flush()
+        self.flush_time = time.perf_counter() - start
+
+    def report(self) -> str:
+        count = len(self.handler_latency)
+        lines = [
+            f"Replayed {count} updates in {self.elapsed:.1f} s "
+            f"({count / self.elapsed:.1f} updates/s, speed-up {self.speed or 'unlimited'})",
+        ]
+        if self.trace_memory:
+            lines.append("Memory was traced with tracemalloc, all timings are inflated!")
+        lines += ["", f"{'[ms]':<18}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"]
+        for name, values in (
+            ("Handler latency", self.handler_latency),
+            ("Queueing delay", self.queueing_delay),
+            ("Persistence", self.persistence_time),
+        ):
+            lines.append(
+                f"{name:<18}{1000 * sum(values) / count:9.2f}"
+                + "".join(f"{1000 * percentile(values, p):9.2f}" for p in (50, 95, 99, 100))
+            )
+        lines.append(f"Final persistence flush {1000 * self.flush_time:.2f} ms")
+
+        lines += [
+            "",
+            "Memory (traced allocations)" if self.trace_memory else "Memory (resident set size)",
+        ]
+        baseline = self.memory[0][2]
+        for elapsed, processed, size in self.memory:
+            lines.append(
+                f"{elapsed:8.1f} s {processed:8d} updates {size / 2**20:10.2f} MiB "
+                f"({(size - baseline) / 2**20:+.2f} MiB)"
+            )
+
+        lines += ["", "Telegram API calls"]
+        lines += [f"  {method}: {calls}" for method, calls in self.api.calls.most_common()]
+        lines.append(
+            f"VVO requests: {self.vvo.requests}, "
+            f"{self.vvo.misses} without recorded response"
+        )
+        lines.append(f"Failed updates and jobs: {self.errors}")
+        return "\n".join(lines)
+
+
+def replay(filenames: Iterable[str], **kwargs) -> Replay:
+    """Replay traffic logs, see `Replay` for the arguments"""
+    return Replay(filenames, **kwargs).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded traffic (RACINGTEAM_RECORD) against the bot"
+    )
+    parser.add_argument(
+        "logs", nargs="+", help="traffic logs or directories containing traffic logs"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="speed-up factor for the time between updates, 0 replays without pauses",
+    )
+    parser.add_argument(
+        "--api-delay",
+        type=float,
+        default=0.0,
+        help="seconds the fake Telegram API waits before answering",
+    )
+    parser.add_argument(
+        "--vvo-latency",
+        type=float,
+        default=1.0,
+        help="factor for the recorded VVO response times, 0 answers immediately",
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=1.0, help="seconds between memory samples"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="trace Python allocations instead of the resident set size, inflates all timings",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.WARNING
+    )
+    print(
+        replay(
+            find_logs(args.logs),
+            speed=args.speed,
+            api_delay=args.api_delay,
+            vvo_latency=args.vvo_latency,
+            sample_interval=args.sample_interval,
+            trace_memory=args.trace_memory,
+        ).report()
+    )
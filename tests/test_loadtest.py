@@ -0,0 +1,283 @@
+import gzip
+import logging
+import pickle
+import queue
+from types import SimpleNamespace
+
+import pytest
+import vvo
+from telegram import Update
+from telegram.ext import ExtBot
+
+from RacingTeam.loadtest import (
+    FAKE_TOKEN,
+    VVO_FUNCTIONS,
+    Anonymizer,
+    Recorder,
+    Replay,
+    coarsen_distances,
+    find_logs,
+    read_log,
+    record,
+    vvo_key,
+)
+
+
+class StopsResponse:
+    def __init__(self, points):
+        self.points = points
+
+
+def command_update(update_id: int, command: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000 + update_id,
+            "chat": {"id": 42, "type": "private", "first_name": "Max"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Max"},
+            "text": command,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}],
+        },
+    }
+
+
+def test_anonymizer_removes_personal_data():
+    anonymize = Anonymizer(b"secret")
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 2,
+            "from": {"id": 42, "first_name": "Max", "last_name": "Mustermann", "username": "max"},
+            "chat": {"id": -100, "type": "group", "title": "Family"},
+            "text": "Hauptbahnhof",
+            "caption": "My home",
+            "forward_sender_name": "Erika Mustermann",
+            "forward_signature": "Erika",
+            "author_signature": "Max",
+            "venue": {"title": "Home", "address": "Somewhere 1"},
+            "location": {"latitude": 51.0401234, "longitude": 13.7321234},
+            "reply_to_message": {"message_id": 1, "text": "Private", "entities": []},
+        },
+    }
+    message = anonymize(update)["message"]
+
+    assert message["from"] == {"id": anonymize.pseudonym(42), "first_name": "User"}
+    assert message["from"]["id"] != 42
+    assert message["chat"] == {"id": anonymize.pseudonym(-100), "type": "group"}
+    assert message["chat"]["id"] < 0
+    assert message["text"] == "Hauptbahnhof"
+    for key in ("caption", "venue", "forward_sender_name", "forward_signature", "author_signature"):
+        assert key not in message
+    assert message["location"] == {"latitude": 51.04, "longitude": 13.732}
+    assert message["reply_to_message"] == {"message_id": 1}
+
+
+def test_anonymizer_removes_bot_message_text():
+    anonymize = Anonymizer(b"secret")
+    update = {
+        "callback_query": {
+            "id": "1",
+            "from": {"id": 42, "first_name": "Max"},
+            "message": {
+                "message_id": 3,
+                "text": "Ich habe mehrere Haltestellen gefunden, bitte wähle eine aus:",
+                "reply_markup": {
+                    "inline_keyboard": [[{"text": "Hauptbahnhof (123 m)", "callback_data": 1}]]
+                },
+            },
+            "data": "data",
+        }
+    }
+    query = anonymize(update)["callback_query"]
+
+    assert query["message"] == {
+        "message_id": 3,
+        "reply_markup": {"inline_keyboard": [[{"text": "Button", "callback_data": 1}]]},
+    }
+    assert query["from"]["id"] == anonymize.pseudonym(42)
+    assert query["data"] == "data"
+
+
+def test_pseudonyms_are_stable_per_secret():
+    assert Anonymizer(b"a").pseudonym(42) == Anonymizer(b"a").pseudonym(42)
+    assert Anonymizer(b"a").pseudonym(42) != Anonymizer(b"b").pseudonym(42)
+
+
+def test_coarsen_distances():
+    points = [SimpleNamespace(id=1, distance=123), SimpleNamespace(id=2, distance=None)]
+    response = StopsResponse(points)
+    coarse = coarsen_distances(response)
+
+    assert [point.distance for point in coarse.points] == [100, None]
+    assert [point.id for point in coarse.points] == [1, 2]
+    # The response used by the bot is not changed
+    assert response.points is points and points[0].distance == 123
+
+
+def test_vvo_key_matches_rounded_location():
+    location = {"latitude": 51.0401234, "longitude": 13.7321234}
+    rounded = Anonymizer(b"secret")({"location": location})["location"]
+
+    recorded = vvo_key(
+        "find_stops",
+        ((location["longitude"], location["latitude"]),),
+        {"shortcuts": True, "limit": 3},
+    )
+    replayed = vvo_key(
+        "find_stops",
+        ((rounded["longitude"], rounded["latitude"]),),
+        {"limit": 3, "shortcuts": True},
+    )
+    assert recorded == replayed
+    assert recorded != vvo_key("find_stops", ("Hauptbahnhof",), {"shortcuts": True, "limit": 3})
+    assert recorded != vvo_key(
+        "find_stops", ((rounded["longitude"], rounded["latitude"]),), {"limit": 1}
+    )
+
+
+def test_read_log(tmp_path):
+    filename = str(tmp_path / "traffic.log.gz")
+    recorder = Recorder(filename)
+    recorder.write("update", 1.0, {"update_id": 1})
+    recorder.write("vvo", 2.0, "find_stops", "key", 0.1, b"data")
+    recorder.close()
+
+    assert list(read_log(filename)) == [
+        ("update", 1.0, {"update_id": 1}),
+        ("vvo", 2.0, "find_stops", "key", 0.1, b"data"),
+    ]
+    with pytest.raises(FileExistsError):
+        Recorder(filename)
+
+
+def test_read_log_of_running_bot(tmp_path):
+    filename = str(tmp_path / "traffic.log.gz")
+    recorder = Recorder(filename)
+    recorder.write("update", 1.0, {"update_id": 1})
+    recorder.write("update", 2.0, {"update_id": 2})
+
+    # Only flushed, the gzip stream is not finished yet
+    assert [record[1] for record in read_log(filename)] == [1.0, 2.0]
+    recorder.close()
+
+
+def test_recorder_disables_on_write_error(tmp_path, caplog):
+    class BrokenFile:
+        closed = False
+
+        def write(self, data):
+            raise OSError("No space left on device")
+
+    recorder = Recorder(str(tmp_path / "traffic.log.gz"))
+    recorder._file.close()
+    recorder._file = BrokenFile()
+    recorder.write("update", 1.0, {"update_id": 1})
+    recorder.write("update", 2.0, {"update_id": 2})
+
+    assert not recorder.enabled
+    assert len([r for r in caplog.records if "recording stopped" in r.getMessage()]) == 1
+
+
+def test_read_log_appended_to_unfinished_log(tmp_path, caplog):
+    filename = str(tmp_path / "traffic.log.gz")
+    first = [("update", float(i), {"update_id": i}) for i in range(3)]
+    unfinished = gzip.open(filename, "wb")
+    for record in first:
+        unfinished.write(pickle.dumps(record))
+    unfinished.flush()
+    with gzip.open(filename, "ab") as file:
+        file.write(pickle.dumps(("update", 10.0, {"update_id": 10})))
+
+    with caplog.at_level(logging.WARNING):
+        records = list(read_log(filename))
+    assert records == first
+    assert "is corrupted" in caplog.text
+    unfinished.close()
+
+
+def test_replay(tmp_path):
+    filename = str(tmp_path / "traffic.log.gz")
+    recorder = Recorder(filename)
+    recorder.write("update", 1.0, command_update(1, "/start"))
+    recorder.write("update", 1.5, command_update(2, "/help"))
+    recorder.close()
+
+    replay = Replay([filename], speed=0, vvo_latency=0, sample_interval=0.1).run()
+
+    assert len(replay.handler_latency) == 2
+    assert len(replay.queueing_delay) == 2
+    assert len(replay.persistence_time) == 2
+    assert replay.api.calls["sendMessage"] == 2
+    assert replay.vvo.requests == 0
+    assert replay.errors == 0
+    assert len(replay.memory) >= 2
+    assert "Replayed 2 updates" in replay.report()
+
+
+def test_record_and_replay(tmp_path, monkeypatch):
+    calls = []
+
+    def find_stops(*args, **kwargs):
+        calls.append(args)
+        return StopsResponse([])
+
+    # Restores the functions wrapped by record()
+    for name in VVO_FUNCTIONS:
+        monkeypatch.setattr(vvo, name, getattr(vvo, name))
+    monkeypatch.setattr(vvo, "find_stops", find_stops)
+
+    updater = SimpleNamespace(update_queue=queue.Queue())
+    recorder = record(updater, str(tmp_path))
+    location = {"latitude": 51.0401234, "longitude": 13.7321234}
+    update = Update.de_json(
+        {
+            "update_id": 1,
+            "message": {
+                "message_id": 1,
+                "date": 1700000000,
+                "chat": {"id": 42, "type": "private"},
+                "from": {"id": 42, "is_bot": False, "first_name": "Max"},
+                "location": location,
+            },
+        },
+        ExtBot(FAKE_TOKEN),
+    )
+    updater.update_queue.put(update)
+    # What the departures handler does for this update
+    vvo.find_stops((location["longitude"], location["latitude"]), shortcuts=True, limit=3)
+    recorder.close()
+
+    assert updater.update_queue.get_nowait() is update
+    assert len(calls) == 1
+    logs = find_logs([str(tmp_path)])
+    assert logs == [recorder.filename]
+    records = list(read_log(recorder.filename))
+    assert [r[0] for r in records] == ["update", "vvo"]
+    assert records[0][2]["message"]["location"] == {"latitude": 51.04, "longitude": 13.732}
+
+    replay = Replay(logs, speed=0, vvo_latency=0, sample_interval=0.1).run()
+
+    assert len(calls) == 1
+    assert replay.vvo.requests == 1
+    assert replay.vvo.misses == 0
+    assert replay.errors == 0
+    assert replay.api.calls["sendMessage"] == 1
+
+
+def test_recording_failure_does_not_drop_update(tmp_path, monkeypatch):
+    for name in VVO_FUNCTIONS:
+        monkeypatch.setattr(vvo, name, getattr(vvo, name))
+    updater = SimpleNamespace(update_queue=queue.Queue())
+    recorder = record(updater, str(tmp_path))
+
+    def broken(data):
+        raise ValueError("broken")
+
+    recorder.anonymize = broken
+    update = Update.de_json({"update_id": 1}, ExtBot(FAKE_TOKEN))
+    updater.update_queue.put(update)
+    recorder.close()
+
+    assert updater.update_queue.get_nowait() is update
+    assert list(read_log(recorder.filename)) == []